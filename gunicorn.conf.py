@@ -0,0 +1,117 @@
+"""
+Gunicorn settings, used by the Procfile and render.yaml:
+
+    $ gunicorn -c gunicorn.conf.py
+
+GUNICORN_PROFILE picks how requests are served:
+- gthread (default): a pool of threads per worker
+- sync: one request per worker process, event streams are refused
+- async: the ASGI entry point (src/asgi.py) on uvicorn workers
+
+Workers and threads are sized from the CPUs available to the process (its
+affinity, bounded by the cgroup CPU quota of the container) and can be
+overridden with WEB_CONCURRENCY and GUNICORN_THREADS. The app is preloaded
+in the master so workers share its imported code, and every worker drops the
+database connections it inherited from the master before serving anything.
+"""
+import math
+import os
+
+profile = os.getenv('GUNICORN_PROFILE', 'gthread')
+if profile not in ('sync', 'gthread', 'async'):
+    raise RuntimeError(f"Unknown GUNICORN_PROFILE {profile!r}, use sync, gthread or async")
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # Containers are usually limited by a CPU quota, not by affinity: cgroup v2 has "<quota> <period>"
+    # in microseconds, or "max <period>" without a limit
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+    except (OSError, ValueError):
+        return cpus
+    if quota == 'max':
+        return cpus
+    return max(min(cpus, math.ceil(int(quota) / int(period))), 1)
+
+
+cpus = available_cpus()
+
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+preload_app = True
+
+if profile == 'sync':
+    wsgi_app = 'wsgi'
+    worker_class = 'sync'
+    workers = cpus * 2 + 1
+elif profile == 'gthread':
+    wsgi_app = 'wsgi'
+    worker_class = 'gthread'
+    workers = cpus + 1
+    # Requests mostly wait on the database, so a few threads per CPU keep it busy
+    threads = int(os.getenv('GUNICORN_THREADS', cpus * 4))
+else:
+    wsgi_app = 'asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    workers = cpus
+
+workers = int(os.getenv('WEB_CONCURRENCY', workers))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so slow memory growth can't pile up, the jitter keeps
+# them from all restarting at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+# A worker above this resident size (MB) finishes its current request and is replaced, 0 disables it
+max_worker_memory_mb = int(os.getenv('GUNICORN_MAX_WORKER_MEMORY_MB', 0))
+
+
+def worker_rss_mb():
+    with open('/proc/self/statm') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def post_fork(server, worker):
+    import sys
+    from app import app
+    from models import db
+
+    # close=False drops the pooled connections without closing the sockets the master still owns
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    asgi = sys.modules.get('asgi')
+    if asgi is not None:
+        asgi.engine.sync_engine.dispose(close=False)
+
+    import tracing
+    if tracing.exporter is not None:
+        tracing.exporter.start()
+
+    # Flask event streams hold a thread each: none on sync workers, at most half the threads of a
+    # gthread worker so other requests still get served (the async profile streams natively)
+    from events import hub
+    if profile == 'sync':
+        hub.max_blocking_streams = 0
+    elif profile == 'gthread':
+        hub.max_blocking_streams = threads // 2
+
+
+def post_request(worker, req, environ, resp):
+    if max_worker_memory_mb <= 0:
+        return
+    try:
+        rss = worker_rss_mb()
+    except OSError:
+        return
+    if rss > max_worker_memory_mb:
+        worker.log.warning("Worker using %.0f MB (limit %d MB), restarting it", rss, max_worker_memory_mb)
+        worker.alive = False
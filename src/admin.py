@@ -1,20 +1,72 @@
 import os
-from flask_admin import Admin
+import threading
+from flask import Flask
 from models import db, User, Favorite, People, Planet, Vehicle
-from flask_admin.contrib.sqla import ModelView
 
-def setup_admin(app):
-    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
+ADMIN_PREFIX = '/admin'
+
+
+def build_admin(app):
+    # Flask-Admin is heavy to import, so it is only loaded when the admin is actually mounted
+    from flask_admin import Admin
+    from admin_views import ScalableModelView
+
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
+
     # Add your models here, for example this is how we add a the User model to the admin
-    admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Favorite, db.session))
-    admin.add_view(ModelView(People, db.session))
-    admin.add_view(ModelView(Planet, db.session))
-    admin.add_view(ModelView(Vehicle, db.session))
+    admin.add_view(ScalableModelView(User, db.session))
+    admin.add_view(ScalableModelView(Favorite, db.session))
+    admin.add_view(ScalableModelView(People, db.session))
+    admin.add_view(ScalableModelView(Planet, db.session))
+    admin.add_view(ScalableModelView(Vehicle, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ScalableModelView(YourModelName, db.session))
+    return admin
+
+
+class LazyAdminMiddleware:
+    """
+    Serves /admin from a separate Flask app that is only built the first time
+    someone opens the admin, so API workers don't pay for it at startup.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self._admin_app = None
+        self._lock = threading.Lock()
+
+    def get_admin_app(self):
+        if self._admin_app is None:
+            with self._lock:
+                if self._admin_app is None:
+                    admin_app = Flask(__name__)
+                    admin_app.config.update(self.app.config)
+                    admin_app.secret_key = self.app.secret_key
+                    admin_app.url_map.strict_slashes = False
+                    db.init_app(admin_app)
+                    build_admin(admin_app)
+                    self._admin_app = admin_app
+        return self._admin_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path == ADMIN_PREFIX or path.startswith(ADMIN_PREFIX + '/'):
+            return self.get_admin_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+
+def setup_admin(app):
+    app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
+
+    # ADMIN_MODE is "eager" (mount at startup), "lazy" (mount on first /admin request) or "off"
+    admin_mode = os.environ.get('ADMIN_MODE', 'eager')
+    if admin_mode == 'off':
+        return
+    if admin_mode == 'lazy':
+        app.wsgi_app = LazyAdminMiddleware(app, app.wsgi_app)
+    else:
+        build_admin(app)
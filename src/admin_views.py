@@ -0,0 +1,146 @@
+"""
+Flask-Admin list views that stay fast on large tables.
+
+Kept apart from admin.py so Flask-Admin is only imported when the admin is
+actually mounted.
+"""
+import os
+from flask import g, request
+from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import UniqueConstraint, text
+from sqlalchemy.orm import joinedload, noload
+
+
+def indexed_columns(table):
+    # Columns an index can serve an ORDER BY for: primary key and leading index/unique columns
+    columns = set(table.primary_key.columns)
+    columns.update(c for c in table.columns if c.unique or c.index)
+    for index in table.indexes:
+        columns.add(list(index.columns)[0])
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint) and len(constraint.columns):
+            columns.add(list(constraint.columns)[0])
+    return {c.name for c in columns}
+
+
+class ScalableModelView(ModelView):
+    """
+    ModelView for tables too big for exact counts and OFFSET paging.
+
+    - Without search or filters, the total shown on Postgres is the planner
+      estimate once the table has more than `estimated_count_threshold` rows.
+    - Only indexed columns are sortable, the default order is the primary key.
+    - The "next page" link carries the last key of the page (`after=`) and
+      that page seeks past it (keyset paging) when the sort column is unique
+      and not nullable; any other page is read with OFFSET.
+    - Relationship collections are never loaded for the list page.
+    """
+
+    column_display_pk = True
+    column_default_sort = 'id'
+    estimated_count_threshold = int(os.getenv('ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000))
+
+    def get_sortable_columns(self):
+        table = self.model.__table__
+        indexed = indexed_columns(table)
+        sortable = dict()
+        for name, field in super().get_sortable_columns().items():
+            column = getattr(field, 'expression', field)
+            if getattr(column, 'table', None) is table and column.name in indexed:
+                sortable[name] = field
+        return sortable
+
+    def get_query(self):
+        collections = [rel for rel in self.model.__mapper__.relationships if rel.uselist]
+        return super().get_query().options(*[noload(getattr(self.model, rel.key)) for rel in collections])
+
+    def estimate_count(self):
+        bind = self.session.get_bind()
+        if bind.dialect.name != 'postgresql':
+            return None
+        table_name = bind.dialect.identifier_preparer.format_table(self.model.__table__)
+        estimate = self.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table_name AS regclass)"),
+            {"table_name": table_name}
+        ).scalar()
+        # reltuples is -1 (or 0) until the table has been analyzed
+        if estimate is None or estimate < self.estimated_count_threshold:
+            return None
+        return int(estimate)
+
+    def keyset_column(self, sort_column):
+        if sort_column is None:
+            return list(self.model.__table__.primary_key.columns)[0]
+        field = self._sortable_columns.get(sort_column)
+        column = getattr(field, 'expression', field)
+        if column is None or getattr(column, 'table', None) is not self.model.__table__:
+            return None
+        if column.primary_key or (column.unique and not column.nullable):
+            return column
+        return None
+
+    def seek_value(self, key_column):
+        # The `after` key of the URL, converted to the column's type; None if absent or unusable
+        after = request.args.get('after')
+        if after is None:
+            return None
+        try:
+            return key_column.type.python_type(after)
+        except (NotImplementedError, TypeError, ValueError):
+            return None
+
+    def _get_list_url(self, view_args):
+        # `after` only ever belongs to the link to the page following the one being shown
+        extra_args = {k: v for k, v in view_args.extra_args.items() if k != 'after'}
+        page_end = g.get('admin_page_end')
+        if page_end is not None and view_args.page == page_end[0] + 1:
+            extra_args['after'] = page_end[1]
+        return super()._get_list_url(view_args.clone(extra_args=extra_args))
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        joins = {}
+        count_joins = {}
+
+        query = self.get_query()
+        count_query = self.get_count_query() if not self.simple_list_pager else None
+
+        searching = bool(self._search_supported and search)
+        filtering = bool(filters and self._filters)
+        if searching:
+            query, count_query, joins, count_joins = self._apply_search(query, count_query, joins, count_joins, search)
+        if filtering:
+            query, count_query, joins, count_joins = self._apply_filters(query, count_query, joins, count_joins, filters)
+
+        count = None
+        if count_query is not None:
+            if not searching and not filtering:
+                count = self.estimate_count()
+            if count is None:
+                count = count_query.scalar()
+
+        for j in self._auto_joins:
+            query = query.options(joinedload(j))
+
+        query, joins = self._apply_sorting(query, joins, sort_column, sort_desc)
+
+        if page_size is None:
+            page_size = self.page_size
+        key_column = self.keyset_column(sort_column)
+        previous_end = None
+        if page and page_size and key_column is not None:
+            previous_end = self.seek_value(key_column)
+
+        if previous_end is not None:
+            query = query.filter(key_column < previous_end if sort_desc else key_column > previous_end)
+            query = query.limit(page_size)
+        else:
+            query = self._apply_pagination(query, page, page_size)
+
+        if execute:
+            query = query.all()
+            if key_column is not None and page_size and query:
+                attribute = self.model.__mapper__.get_property_by_column(key_column).key
+                g.admin_page_end = (page or 0, getattr(query[-1], attribute))
+
+        return count, query
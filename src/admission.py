@@ -0,0 +1,257 @@
+"""
+Admission control and per-client rate limiting.
+
+Runs before every route so excess load is turned away in microseconds instead
+of queueing in front of the database:
+
+- a request that already waited longer than ADMISSION_MAX_QUEUE_MS in front
+  of the app (from the proxy's X-Request-Start header) gets a 503,
+- every client gets a token bucket; an empty bucket means a 429,
+- each worker caps the requests it runs at once, overall and per route class
+  (list, single item, write); above the cap the request gets a 503.
+
+The concurrency caps only matter for workers serving several requests at once
+(the gthread profile, the default, and the async one). A sync worker runs one
+request at a time and the rest wait in gunicorn's backlog, there only the queue
+time check sheds load. The routes asgi.py serves natively go through the same
+checks, buckets and caps in its AdmissionMiddleware.
+
+A request that will share the response of an identical one already running
+(see coalescing.py) does not take a slot: it only waits, the database work is
+counted once.
+
+All answers carry Retry-After. Buckets live in this process by default, or in
+a SQLite file shared by all workers on the host (RATE_LIMIT_STORE=sqlite).
+Limits can be changed at runtime through the JSON file named by
+ADMISSION_CONFIG, e.g. {"max_list": 4, "rate_per_second": 5}.
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from utils import APIException, RuntimeSettings
+
+logger = logging.getLogger(__name__)
+
+# Endpoints with their own limits (event streams) are never counted
+EXEMPT_ENDPOINTS = {'static', 'get_user_events', 'get_catalog_events'}
+
+settings = RuntimeSettings(os.getenv('ADMISSION_CONFIG'), {
+    'max_queue_ms': float(os.getenv('ADMISSION_MAX_QUEUE_MS', 0)),
+    'max_concurrent': int(os.getenv('ADMISSION_MAX_CONCURRENT', 32)),
+    'max_list': int(os.getenv('ADMISSION_MAX_LIST', 8)),
+    'max_single': int(os.getenv('ADMISSION_MAX_SINGLE', 24)),
+    'max_write': int(os.getenv('ADMISSION_MAX_WRITE', 8)),
+    'rate_per_second': float(os.getenv('RATE_LIMIT_PER_SECOND', 20)),
+    'burst': float(os.getenv('RATE_LIMIT_BURST', 40)),
+})
+
+
+def route_class():
+    if request.method not in ('GET', 'HEAD'):
+        return 'write'
+    if request.url_rule is not None and request.url_rule.arguments:
+        return 'single'
+    return 'list'
+
+
+# Number of proxies in front of the app that append to X-Forwarded-For (1 on Render)
+TRUSTED_PROXY_HOPS = int(os.getenv('RATE_LIMIT_TRUST_PROXY', 0))
+
+
+def forwarded_client(forwarded, remote_addr):
+    # Every trusted proxy appends the address it got the request from, so the client is that many
+    # entries from the right. Anything further left was sent by the client itself and can be forged.
+    if TRUSTED_PROXY_HOPS > 0 and forwarded:
+        addresses = [address.strip() for address in forwarded.split(',')]
+        if len(addresses) >= TRUSTED_PROXY_HOPS:
+            return addresses[-TRUSTED_PROXY_HOPS]
+    return remote_addr or 'unknown'
+
+
+def client_key():
+    return forwarded_client(request.headers.get('X-Forwarded-For'), request.remote_addr)
+
+
+def queue_time_ms(request_start):
+    # X-Request-Start as set by nginx ("t=1700000000.123", seconds) or by routers sending
+    # milliseconds or microseconds since the epoch
+    value = (request_start or '').strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started_at = float(value)
+    except ValueError:
+        return None
+    if started_at > 1e14:
+        started_at /= 1e6
+    elif started_at > 1e11:
+        started_at /= 1e3
+    return (time.time() - started_at) * 1000
+
+
+class ConcurrencyLimiter:
+
+    def __init__(self):
+        self._in_flight = {'total': 0, 'list': 0, 'single': 0, 'write': 0}
+        self._lock = threading.Lock()
+
+    def acquire(self, kind):
+        limits = {'total': settings.get('max_concurrent'), kind: settings.get('max_' + kind)}
+        with self._lock:
+            if any(self._in_flight[k] >= limit for k, limit in limits.items()):
+                return False
+            self._in_flight['total'] += 1
+            self._in_flight[kind] += 1
+            return True
+
+    def release(self, kind):
+        with self._lock:
+            self._in_flight['total'] -= 1
+            self._in_flight[kind] -= 1
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    return min(burst, tokens + (now - updated_at) * rate)
+
+
+class MemoryBucketStore:
+    """Token buckets of this worker, the least recently seen clients are forgotten first."""
+
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        # Returns 0 if a token was taken, otherwise the seconds until one is available
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated_at, now, rate, burst)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if wait == 0 else tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class SqliteBucketStore:
+    """Token buckets in a SQLite file, shared by every worker on the host."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # Short busy timeout, a request waiting on the limiter is what admission control avoids
+            conn = sqlite3.connect(self.path, timeout=0.1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # No fsync per request: in WAL mode NORMAL only risks the last buckets on power loss
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, rate, burst, now):
+        try:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated_at FROM bucket WHERE key = ?", (key,)).fetchone()
+                tokens = refill(row[0], row[1], now, rate, burst) if row else burst
+                wait = 0 if tokens >= 1 else (1 - tokens) / rate
+                conn.execute(
+                    "INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (key, tokens - 1 if wait == 0 else tokens, now)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.OperationalError as e:
+            # A busy or broken store must not fail the request, let it through unlimited
+            logger.warning("Rate limit store unavailable, not limiting %s: %s", key, e)
+            return 0
+        return wait
+
+
+limiter = ConcurrencyLimiter()
+
+
+def acquire_slot(kind):
+    if not limiter.acquire(kind):
+        raise APIException("Server is busy, try again shortly", 503, headers={"Retry-After": "1"})
+
+
+def admit(kind):
+    acquire_slot(kind)
+    g.admitted_route_class = kind
+
+
+def suspend_admission():
+    """Give back the slot of the current request while it waits on another request's work."""
+    kind = g.pop('admitted_route_class', None)
+    if kind is not None:
+        limiter.release(kind)
+        g.suspended_route_class = kind
+
+
+def resume_admission():
+    """Take a slot again for a suspended request that has to do its own work after all."""
+    kind = g.pop('suspended_route_class', None)
+    if kind is not None:
+        admit(kind)
+
+
+def create_bucket_store():
+    if os.getenv('RATE_LIMIT_STORE', 'memory') == 'sqlite':
+        return SqliteBucketStore(os.getenv('RATE_LIMIT_DB', '/tmp/rate_limit.db'))
+    return MemoryBucketStore()
+
+
+# Shared with the native routes of asgi.py, a client has one budget whichever entry point serves it
+buckets = create_bucket_store()
+
+
+def check_load(client, request_start):
+    """Turn the request away if it queued too long or its client is over the rate limit."""
+    max_queue_ms = settings.get('max_queue_ms')
+    if max_queue_ms > 0:
+        queued_ms = queue_time_ms(request_start)
+        if queued_ms is not None and queued_ms > max_queue_ms:
+            raise APIException("Server is busy, try again shortly", 503, headers={"Retry-After": "1"})
+
+    rate = settings.get('rate_per_second')
+    if rate > 0:
+        wait = buckets.take(client, rate, max(settings.get('burst'), 1), time.time())
+        if wait > 0:
+            raise APIException("Too many requests, slow down", 429, headers={"Retry-After": str(math.ceil(wait))})
+
+
+def setup_admission(app):
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS or '.' in request.endpoint:
+            return
+
+        check_load(client_key(), request.headers.get('X-Request-Start'))
+
+        kind = route_class()
+        shares_in_flight = getattr(app.view_functions.get(request.endpoint), 'shares_in_flight', None)
+        if shares_in_flight is not None and shares_in_flight():
+            g.suspended_route_class = kind
+            return
+        admit(kind)
+
+    @app.teardown_request
+    def release_request(exc):
+        kind = g.pop('admitted_route_class', None)
+        if kind is not None:
+            limiter.release(kind)
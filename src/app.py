@@ -3,13 +3,22 @@ This module takes care of starting the API Server, Loading the DB and Adding the
 """
 from datetime import timedelta
 import os
+import click
 from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
 from flask_cors import CORS
 from utils import APIException, generate_sitemap
+from admission import setup_admission
 from admin import setup_admin
+from deadlines import deadline, setup_deadlines
+from coalescing import coalesce, single_flight
+from profiling import setup_profiling
+from tracing import setup_tracing
 from models import db, User, Favorite, Vehicle, Planet, People
+from popularity import bump_favorite_count, get_popular, rebuild_favorite_counts, DEFAULT_POPULAR_LIMIT, MAX_POPULAR_LIMIT
+from stats import catalog_stats
+from changes import get_changes, DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT
+from events import hub, parse_last_event_id, stream_response
+from recommendations import record_cooccurrence, get_related, rebuild_related, DEFAULT_RELATED_LIMIT, MAX_RELATED_LIMIT
 
 app = Flask(__name__)
 app.url_map.strict_slashes = False
@@ -21,22 +30,49 @@ else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-MIGRATE = Migrate(app, db)
+# Flask-Migrate pulls in alembic, which is slow to import and only needed by the
+# `flask db` commands, so web workers started by gunicorn skip it
+if click.get_current_context(silent=True) is not None:
+    from flask_migrate import Migrate
+    MIGRATE = Migrate(app, db)
 db.init_app(app)
 CORS(app)
+setup_admission(app)
+setup_deadlines(app)
 setup_admin(app)
+setup_profiling(app)
+setup_tracing(app)
+hub.init_app(app)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
 def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+    return jsonify(error.to_dict()), error.status_code, error.headers
 
 # generate sitemap with all your endpoints
 @app.route('/')
 def sitemap():
     return generate_sitemap(app)
 
+# Recompute the favorite counters from the favorites tables: `flask rebuild-favorite-counts`
+@app.cli.command('rebuild-favorite-counts')
+def rebuild_favorite_counts_command():
+    rebuild_favorite_counts()
+    print("Favorite counts rebuilt")
+
+# Rebuild the "also favorited" index from the favorites tables: `flask rebuild-related`
+@app.cli.command('rebuild-related')
+def rebuild_related_command():
+    rebuild_related()
+    print("Related items rebuilt")
+
+def limit_arg(default, maximum):
+    limit = request.args.get('limit', default, type=int)
+    return min(max(limit, 1), maximum)
+
 @app.route('/users', methods=['GET'])
+@deadline(5000)
+@coalesce
 def get_all_users():
     all_users = User.query.all()
     
@@ -77,6 +113,7 @@ def get_user(user_id):
 
 # Show current user favorites
 @app.route('/users/<int:user_id>/favorites', methods=['GET'])
+@coalesce
 def get_user_favorites(user_id):
     user = User.query.get(user_id)
     
@@ -112,7 +149,9 @@ def add_favorite_people(user_id, people_id):
     if people_to_add in user_favorites.people:
         raise APIException(f"People with id #{people_id} is already in user favorites", 400)
     
+    record_cooccurrence("people", people_id, [x.id for x in user_favorites.people], 1)
     user_favorites.people.append(people_to_add)
+    bump_favorite_count("people", people_id, 1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 201
@@ -139,6 +178,8 @@ def delete_favorite_people(user_id, people_id):
         raise APIException(f"People with id #{people_id} is not in user favorites", 404)
     
     user_favorites.people.remove(people_to_remove)
+    bump_favorite_count("people", people_id, -1)
+    record_cooccurrence("people", people_id, [x.id for x in user_favorites.people], -1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 200
@@ -165,7 +206,9 @@ def add_favorite_planet(user_id, planet_id):
     if planet_to_add in user_favorites.planets:
         raise APIException(f"Planet with id #{planet_id} is already in user favorites", 400)
     
+    record_cooccurrence("planet", planet_id, [x.id for x in user_favorites.planets], 1)
     user_favorites.planets.append(planet_to_add)
+    bump_favorite_count("planet", planet_id, 1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 201
@@ -192,6 +235,8 @@ def delete_favorite_planet(user_id, planet_id):
         raise APIException(f"Planet with id #{planet_id} is not in user favorites", 404)
     
     user_favorites.planets.remove(planet_to_remove)
+    bump_favorite_count("planet", planet_id, -1)
+    record_cooccurrence("planet", planet_id, [x.id for x in user_favorites.planets], -1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 200
@@ -218,7 +263,9 @@ def add_favorite_vehicle(user_id, vehicle_id):
     if vehicle_to_add in user_favorites.vehicles:
         raise APIException(f"Vehicle with id #{vehicle_id} is already in user favorites", 400)
         
+    record_cooccurrence("vehicle", vehicle_id, [x.id for x in user_favorites.vehicles], 1)
     user_favorites.vehicles.append(vehicle_to_add)
+    bump_favorite_count("vehicle", vehicle_id, 1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 201
@@ -245,12 +292,16 @@ def delete_favorite_vehicle(user_id, vehicle_id):
         raise APIException(f"Vehicle with id #{vehicle_id} is not in user favorites", 404)
     
     user_favorites.vehicles.remove(vehicle_to_remove)
+    bump_favorite_count("vehicle", vehicle_id, -1)
+    record_cooccurrence("vehicle", vehicle_id, [x.id for x in user_favorites.vehicles], -1)
     db.session.commit()
     
     return jsonify(user_favorites.serialize()), 200
 
 # Get all people
 @app.route('/people', methods=['GET'])
+@deadline(5000)
+@coalesce
 def get_all_people():
     all_people = People.query.all()
     
@@ -293,9 +344,23 @@ def create_people():
     # Add the new people to the database
     db.session.add(new_people)
     db.session.commit()
+    catalog_stats.add("people", new_people)
     
     return jsonify(new_people.serialize()), 201
     
+# Get the people most users have in their favorites
+@app.route('/people/popular', methods=['GET'])
+def get_popular_people():
+    return jsonify(get_popular("people", limit_arg(DEFAULT_POPULAR_LIMIT, MAX_POPULAR_LIMIT))), 200
+
+# Get the people most often favorited together with people_id
+@app.route('/people/<int:people_id>/related', methods=['GET'])
+def get_related_people(people_id):
+    if People.query.get(people_id) is None:
+        raise APIException(f"People with id #{people_id} not exist in database", 404)
+
+    return jsonify(get_related("people", people_id, limit_arg(DEFAULT_RELATED_LIMIT, MAX_RELATED_LIMIT))), 200
+
 # Get people by people_id
 @app.route('/people/<int:people_id>', methods=['GET'])
 def get_people(people_id):
@@ -308,6 +373,8 @@ def get_people(people_id):
 
 # Get all planets
 @app.route('/planets', methods=['GET'])
+@deadline(5000)
+@coalesce
 def get_all_planets():
     all_planets = Planet.query.all()
     
@@ -352,9 +419,23 @@ def create_planet():
     # Add the new people to the database
     db.session.add(new_planet)
     db.session.commit()
+    catalog_stats.add("planets", new_planet)
     
     return jsonify(new_planet.serialize()), 201
 
+# Get the planets most users have in their favorites
+@app.route('/planets/popular', methods=['GET'])
+def get_popular_planets():
+    return jsonify(get_popular("planet", limit_arg(DEFAULT_POPULAR_LIMIT, MAX_POPULAR_LIMIT))), 200
+
+# Get the planets most often favorited together with planet_id
+@app.route('/planets/<int:planet_id>/related', methods=['GET'])
+def get_related_planets(planet_id):
+    if Planet.query.get(planet_id) is None:
+        raise APIException(f"Planet with id #{planet_id} not exist in database", 404)
+
+    return jsonify(get_related("planet", planet_id, limit_arg(DEFAULT_RELATED_LIMIT, MAX_RELATED_LIMIT))), 200
+
 # Get planet by planet_id
 @app.route('/planets/<int:planet_id>', methods=['GET'])
 def get_planet(planet_id):
@@ -367,6 +448,8 @@ def get_planet(planet_id):
 
 # Get all vehicles
 @app.route('/vehicles', methods=['GET'])
+@deadline(5000)
+@coalesce
 def get_all_vehicles():
     all_vehicles = Vehicle.query.all()
     
@@ -416,6 +499,19 @@ def create_vehicle():
     
     return jsonify(new_vehicle.serialize()), 201
 
+# Get the vehicles most users have in their favorites
+@app.route('/vehicles/popular', methods=['GET'])
+def get_popular_vehicles():
+    return jsonify(get_popular("vehicle", limit_arg(DEFAULT_POPULAR_LIMIT, MAX_POPULAR_LIMIT))), 200
+
+# Get the vehicles most often favorited together with vehicle_id
+@app.route('/vehicles/<int:vehicle_id>/related', methods=['GET'])
+def get_related_vehicles(vehicle_id):
+    if Vehicle.query.get(vehicle_id) is None:
+        raise APIException(f"Vehicle with id #{vehicle_id} not exist in database", 404)
+
+    return jsonify(get_related("vehicle", vehicle_id, limit_arg(DEFAULT_RELATED_LIMIT, MAX_RELATED_LIMIT))), 200
+
 # Get vehicle by vehicle_id
 @app.route('/vehicles/<int:vehicle_id>', methods=['GET'])
 def get_vehicle(vehicle_id):
@@ -426,6 +522,70 @@ def get_vehicle(vehicle_id):
     
     return jsonify(vehicle.serialize()), 200
 
+# Catalog changes (and the favorites changes of user_id) after the `since` cursor
+@app.route('/changes', methods=['GET'])
+def get_changes_since():
+    since = request.args.get('since', 0, type=int)
+    user_id = request.args.get('user_id', None, type=int)
+
+    if since < 0:
+        raise APIException("The 'since' cursor can't be negative", 400)
+
+    if user_id is not None and User.query.get(user_id) is None:
+        raise APIException(f"User with id #{user_id} not exist in database", 404)
+
+    return jsonify(get_changes(since, limit_arg(DEFAULT_CHANGES_LIMIT, MAX_CHANGES_LIMIT), user_id)), 200
+
+def last_event_id():
+    return parse_last_event_id(request.headers.get('Last-Event-ID', request.args.get('last_event_id')))
+
+# Live stream (Server-Sent Events) of the favorites changes of user_id
+@app.route('/users/<int:user_id>/events', methods=['GET'])
+def get_user_events(user_id):
+    user = User.query.get(user_id)
+
+    if user is None:
+        raise APIException(f"User with id #{user_id} not exist in database", 404)
+
+    return stream_response(user_id, last_event_id())
+
+# Live stream (Server-Sent Events) of catalog changes
+@app.route('/events/catalog', methods=['GET'])
+def get_catalog_events():
+    return stream_response(None, last_event_id())
+
+# List the datasets and columns available for stats
+@app.route('/stats', methods=['GET'])
+def get_stats_columns():
+    return jsonify(catalog_stats.describe()), 200
+
+# Aggregate a numeric column by a categorical one, e.g. /stats/people/group?by=gender&column=height
+@app.route('/stats/<dataset>/group', methods=['GET'])
+def get_stats_group(dataset):
+    by = request.args.get('by')
+    column = request.args.get('column')
+
+    if by is None or column is None:
+        raise APIException("You need to provide the 'by' and 'column' parameters", 400)
+
+    return jsonify(catalog_stats.group_by(dataset, by, column)), 200
+
+# Histogram of a numeric column, e.g. /stats/planets/histogram?column=diameter&bins=20
+@app.route('/stats/<dataset>/histogram', methods=['GET'])
+def get_stats_histogram(dataset):
+    column = request.args.get('column')
+    bins = request.args.get('bins', 10, type=int)
+
+    if column is None:
+        raise APIException("You need to provide the 'column' parameter", 400)
+
+    return jsonify(catalog_stats.histogram(dataset, column, bins)), 200
+
+# Per-worker counters of the coalesced GET routes
+@app.route('/metrics/coalescing', methods=['GET'])
+def get_coalescing_metrics():
+    return jsonify(single_flight.stats()), 200
+
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
@@ -0,0 +1,266 @@
+"""
+Optional ASGI entry point.
+
+The read endpoints (users, favorites and the catalog) and the event streams
+are served by async handlers on an async SQLAlchemy engine, so a slow query or
+an open stream only parks a coroutine instead of tying up a worker. Every other
+route is handed to the Flask app in app.py, run on a thread pool, so behavior
+and JSON are the same whichever entry point is used. The async handlers get the
+deadline of the Flask route they stand in for (see deadlines.py) and go through
+the same admission control (see admission.py).
+
+    $ uvicorn asgi:application --app-dir ./src/
+    $ gunicorn asgi:application --chdir ./src/ -k uvicorn.workers.UvicornWorker
+"""
+import asyncio
+import contextlib
+import time
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import selectinload
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.middleware import Middleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Match, Mount, Route
+from admission import EXEMPT_ENDPOINTS, SqliteBucketStore, acquire_slot, buckets, check_load, forwarded_client, limiter
+from app import app as flask_app
+from deadlines import POSTGRES_QUERY_CANCELED, DeadlineExceeded, budget_ms
+from events import AsyncSubscription, STREAM_HEADERS, async_stream, open_stream, parse_last_event_id
+from models import User, Favorite, People, Planet, Vehicle
+from utils import APIException
+
+ASYNC_DRIVERS = {
+    "postgresql://": "postgresql+asyncpg://",
+    "sqlite://": "sqlite+aiosqlite://",
+}
+
+FAVORITE_LOADERS = (
+    selectinload(Favorite.people),
+    selectinload(Favorite.planets),
+    selectinload(Favorite.vehicles),
+)
+
+
+def async_database_url(url):
+    for prefix, async_prefix in ASYNC_DRIVERS.items():
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    raise RuntimeError(f"No async driver configured for {url.split(':', 1)[0]}")
+
+
+engine = create_async_engine(async_database_url(flask_app.config['SQLALCHEMY_DATABASE_URI']))
+
+
+def json_response(data, status_code=200, headers=None):
+    # Encode with Flask's JSON provider so the body is byte for byte what jsonify returns,
+    # and add the CORS header flask_cors adds to every response
+    body = flask_app.json.response(data)
+    return Response(body.get_data(), status_code=status_code, media_type=body.mimetype,
+                    headers=dict(headers or {}, **{"Access-Control-Allow-Origin": "*"}))
+
+
+async def handle_invalid_usage(request, error):
+    return json_response(error.to_dict(), error.status_code, error.headers)
+
+
+class AdmissionMiddleware:
+    """Admission control (see admission.py) of the native routes, the Flask app applies its own."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = [route for route in routes if isinstance(route, Route)]
+
+    def native_route(self, scope):
+        for route in self.routes:
+            if route.matches(scope)[0] == Match.FULL:
+                return route
+        return None
+
+    async def __call__(self, scope, receive, send):
+        route = self.native_route(scope) if scope['type'] == 'http' else None
+        if route is None or route.name in EXEMPT_ENDPOINTS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        client = forwarded_client(headers.get('X-Forwarded-For'), scope['client'][0] if scope.get('client') else None)
+        # Every native route is a GET
+        kind = 'single' if route.param_convertors else 'list'
+        try:
+            if isinstance(buckets, SqliteBucketStore):
+                # A busy store can block for its whole timeout, keep that off the event loop
+                await run_in_threadpool(check_load, client, headers.get('X-Request-Start'))
+            else:
+                check_load(client, headers.get('X-Request-Start'))
+            acquire_slot(kind)
+        except APIException as e:
+            await json_response(e.to_dict(), e.status_code, e.headers)(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(kind)
+
+
+def with_deadline(endpoint, handler):
+    # Same budget as the Flask view: its @deadline (or REQUEST_DEADLINE_MS), capped by X-Request-Timeout
+    view = flask_app.view_functions[endpoint]
+
+    async def run(request):
+        budget = budget_ms(view, request.headers.get('X-Request-Timeout'))
+        if budget is None:
+            return await handler(request)
+        if budget <= 0:
+            raise DeadlineExceeded()
+        request.state.deadline = time.monotonic() + budget / 1000
+        try:
+            # wait_for rather than asyncio.timeout, which needs Python 3.11
+            return await asyncio.wait_for(handler(request), budget / 1000)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded()
+        except DBAPIError as e:
+            if getattr(e.orig, 'pgcode', None) == POSTGRES_QUERY_CANCELED:
+                raise DeadlineExceeded()
+            raise
+    return run
+
+
+@contextlib.asynccontextmanager
+async def database_session(request):
+    async with AsyncSession(engine) as session:
+        expires_at = getattr(request.state, 'deadline', None)
+        if expires_at is not None and engine.dialect.name == 'postgresql':
+            # Cancelling the coroutine doesn't stop the query, make the server give up on it too
+            remaining = (expires_at - time.monotonic()) * 1000
+            connection = await session.connection()
+            await connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(remaining), 1)}")
+        yield session
+
+
+async def get_all_users(request):
+    async with database_session(request) as session:
+        all_users = await session.scalars(
+            select(User).options(selectinload(User.favorites).options(*FAVORITE_LOADERS))
+        )
+        list_of_users = list(map(lambda x: x.serialize(), all_users))
+
+    return json_response(list_of_users, 200)
+
+
+async def get_user(request):
+    user_id = request.path_params['user_id']
+    async with database_session(request) as session:
+        user = await session.get(User, user_id, options=[selectinload(User.favorites).options(*FAVORITE_LOADERS)])
+
+        if user is None:
+            raise APIException(f"User with id #{user_id} not exist in database", 404)
+
+        return json_response(user.serialize(), 200)
+
+
+async def get_user_favorites(request):
+    user_id = request.path_params['user_id']
+    async with database_session(request) as session:
+        user = await session.get(User, user_id)
+
+        if user is None:
+            raise APIException(f"User with id #{user_id} not exist in database", 404)
+
+        user_favorites = await session.scalar(
+            select(Favorite).filter_by(user_id=user_id).options(*FAVORITE_LOADERS).limit(1)
+        )
+
+        if user_favorites is None:
+            raise APIException("User has no favorites", 404)
+
+        return json_response(user_favorites.serialize(), 200)
+
+
+def list_items(model):
+    async def get_all(request):
+        async with database_session(request) as session:
+            items = await session.scalars(select(model))
+            return json_response(list(map(lambda x: x.serialize(), items)), 200)
+    return get_all
+
+
+def get_item(model, label, param):
+    async def get_one(request):
+        item_id = request.path_params[param]
+        async with database_session(request) as session:
+            item = await session.get(model, item_id)
+
+            if item is None:
+                raise APIException(f"{label} with id #{item_id} not exist in database", 404)
+
+            return json_response(item.serialize(), 200)
+    return get_one
+
+
+def open_stream_in_app(subscription, last_event_id):
+    # The hub and the replay query use the Flask-SQLAlchemy session
+    with flask_app.app_context():
+        return open_stream(subscription, last_event_id)
+
+
+async def event_stream_response(request, user_id):
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID', request.query_params.get('last_event_id')))
+    subscription = AsyncSubscription(user_id, asyncio.get_running_loop())
+    backlog = await run_in_threadpool(open_stream_in_app, subscription, last_event_id)
+    return StreamingResponse(async_stream(subscription, backlog, last_event_id), media_type='text/event-stream',
+                             headers=dict(STREAM_HEADERS, **{"Access-Control-Allow-Origin": "*"}))
+
+
+async def get_user_events(request):
+    user_id = request.path_params['user_id']
+    async with database_session(request) as session:
+        user = await session.get(User, user_id)
+
+        if user is None:
+            raise APIException(f"User with id #{user_id} not exist in database", 404)
+
+    return await event_stream_response(request, user_id)
+
+
+async def get_catalog_events(request):
+    return await event_stream_response(request, None)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await engine.dispose()
+
+
+routes = [
+    Route('/users', with_deadline('get_all_users', get_all_users), methods=['GET']),
+    Route('/users/{user_id:int}', with_deadline('get_user', get_user), methods=['GET']),
+    Route('/users/{user_id:int}/favorites', with_deadline('get_user_favorites', get_user_favorites), methods=['GET']),
+    Route('/people', with_deadline('get_all_people', list_items(People)), methods=['GET']),
+    Route('/people/{people_id:int}', with_deadline('get_people', get_item(People, "People", 'people_id')),
+          methods=['GET']),
+    Route('/planets', with_deadline('get_all_planets', list_items(Planet)), methods=['GET']),
+    Route('/planets/{planet_id:int}', with_deadline('get_planet', get_item(Planet, "Planet", 'planet_id')),
+          methods=['GET']),
+    Route('/vehicles', with_deadline('get_all_vehicles', list_items(Vehicle)), methods=['GET']),
+    Route('/vehicles/{vehicle_id:int}', with_deadline('get_vehicle', get_item(Vehicle, "Vehicle", 'vehicle_id')),
+          methods=['GET']),
+    # No deadline on streams: cancelling one while it subscribes would leave the subscription behind
+    Route('/users/{user_id:int}/events', get_user_events, methods=['GET']),
+    Route('/events/catalog', get_catalog_events, methods=['GET']),
+    # Everything else (writes, stats, admin...) is served by the Flask app, each request on a thread
+    # of the adapter's pool so they don't queue behind each other
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+application = Starlette(
+    routes=routes,
+    middleware=[Middleware(AdmissionMiddleware, routes=routes)],
+    exception_handlers={APIException: handle_invalid_usage},
+    lifespan=lifespan
+)
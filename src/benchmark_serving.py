@@ -0,0 +1,136 @@
+"""
+Compare the sync WSGI deployment with the ASGI entry point.
+
+Starts each server with gunicorn on a local port, drives it with an increasing
+number of concurrent clients and reports throughput, latency and the memory of
+the server processes per in-flight request. Uses the DATABASE_URL of the
+environment, so point it at a database with realistic data.
+
+    $ pipenv run benchmark
+    $ BENCH_PATH=/users/1/favorites BENCH_CONCURRENCY=10,100,400 pipenv run benchmark
+"""
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+PORT = int(os.getenv('BENCH_PORT', 5055))
+WORKERS = int(os.getenv('BENCH_WORKERS', 2))
+DURATION = float(os.getenv('BENCH_DURATION', 10))
+PATH = os.getenv('BENCH_PATH', '/people')
+CONCURRENCY = [int(c) for c in os.getenv('BENCH_CONCURRENCY', '1,10,50,200').split(',')]
+
+SERVERS = {
+    "sync (wsgi)": ['gunicorn', 'wsgi', '--workers', str(WORKERS)],
+    "async (asgi)": ['gunicorn', 'asgi:application', '--workers', str(WORKERS), '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+
+def process_tree_rss_kb(pid):
+    # Sum of VmRSS of pid and all its descendants, read from /proc (Linux only)
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total
+
+
+def wait_until_ready(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=1)
+            conn.request('GET', PATH)
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def run_load(concurrency):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + DURATION
+
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+        while time.monotonic() < stop_at:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', PATH)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 500
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=60)
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] * 1000 if len(values) > 1 else float('nan')
+
+
+def benchmark(name, command):
+    server = subprocess.Popen(command + ['--bind', f'127.0.0.1:{PORT}'], cwd=SRC_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready()
+        idle_rss = process_tree_rss_kb(server.pid)
+        print(f"\n{name}: {WORKERS} workers, idle RSS {idle_rss / 1024:.1f} MB")
+        print(f"{'clients':>8} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'peak MB':>9} {'KB/in-flight':>13}")
+        for concurrency in CONCURRENCY:
+            peak = [idle_rss]
+            sampling = threading.Event()
+
+            def sample_memory():
+                while not sampling.wait(0.2):
+                    peak[0] = max(peak[0], process_tree_rss_kb(server.pid))
+
+            sampler = threading.Thread(target=sample_memory, daemon=True)
+            sampler.start()
+            latencies, errors = run_load(concurrency)
+            sampling.set()
+            sampler.join()
+
+            per_request = (peak[0] - idle_rss) / concurrency
+            print(f"{concurrency:>8} {len(latencies) / DURATION:>9.1f} {percentile(latencies, 50):>9.1f} "
+                  f"{percentile(latencies, 99):>9.1f} {errors:>7} {peak[0] / 1024:>9.1f} {per_request:>13.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    print(f"GET {PATH} for {DURATION:.0f}s per concurrency level")
+    for name, command in SERVERS.items():
+        benchmark(name, command)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""
+Change feed for incremental client sync (GET /changes).
+
+Every flush that creates, updates or deletes a People, Planet or Vehicle, or
+adds/removes one of them from a user's favorites, appends a row to change_log
+in the same transaction. Deletions and removals stay in the log as tombstones.
+Clients keep the last cursor they saw and only ask for what came after it.
+
+The cursor is the log id, so ids must become visible in order. On Postgres
+the sequence hands out ids at flush time and transactions can commit in any
+order, so appending takes a transaction-level advisory lock: ids are assigned
+and committed one writing transaction at a time. SQLite already allows only
+one writer at a time.
+"""
+from sqlalchemy import event, insert, inspect, or_, select, func
+from sqlalchemy.orm import Session
+from models import Change, Favorite, People, Planet, Vehicle
+
+DEFAULT_CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+
+ITEM_TYPES = {People: "people", Planet: "planet", Vehicle: "vehicle"}
+MODELS = {item_type: model for model, item_type in ITEM_TYPES.items()}
+# Favorite collection -> item type stored in the log
+FAVORITE_COLLECTIONS = {"people": "people", "planets": "planet", "vehicles": "vehicle"}
+# Key of the Postgres advisory lock held by transactions appending to change_log
+CHANGE_LOG_LOCK_ID = 0x63686c67
+
+
+def collect_changes(session):
+    changes = []
+    for obj in session.new:
+        if type(obj) in ITEM_TYPES:
+            changes.append({"item_type": ITEM_TYPES[type(obj)], "item_id": obj.id, "action": "created"})
+    for obj in session.dirty:
+        if type(obj) in ITEM_TYPES and session.is_modified(obj, include_collections=False):
+            changes.append({"item_type": ITEM_TYPES[type(obj)], "item_id": obj.id, "action": "updated"})
+    for obj in session.deleted:
+        if type(obj) in ITEM_TYPES:
+            changes.append({"item_type": ITEM_TYPES[type(obj)], "item_id": obj.id, "action": "deleted"})
+
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Favorite):
+            continue
+        state = inspect(obj)
+        for collection, item_type in FAVORITE_COLLECTIONS.items():
+            history = state.attrs[collection].history
+            for item in history.added or ():
+                changes.append({"item_type": item_type, "item_id": item.id, "action": "favorited", "user_id": obj.user_id})
+            for item in history.deleted or ():
+                changes.append({"item_type": item_type, "item_id": item.id, "action": "unfavorited", "user_id": obj.user_id})
+    return changes
+
+
+@event.listens_for(Session, 'after_flush')
+def _log_changes(session, flush_context):
+    changes = collect_changes(session)
+    if changes:
+        connection = session.connection()
+        if connection.dialect.name == 'postgresql':
+            # Held until commit or rollback, so a later id can't be committed before an earlier one
+            connection.execute(select(func.pg_advisory_xact_lock(CHANGE_LOG_LOCK_ID)))
+        # Core insert on the flushing connection, so the log commits or rolls back with the change
+        connection.execute(insert(Change.__table__), [dict({"user_id": None}, **c) for c in changes])
+
+
+def get_changes(since, limit, user_id=None):
+    query = Change.query.filter(Change.id > since)
+    if user_id is None:
+        query = query.filter(Change.user_id.is_(None))
+    else:
+        query = query.filter(or_(Change.user_id.is_(None), Change.user_id == user_id))
+    changes = query.order_by(Change.id).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    # Attach the current state of created/updated items, fetched with one query per type
+    wanted = {}
+    for change in changes:
+        if change.action in ("created", "updated"):
+            wanted.setdefault(change.item_type, set()).add(change.item_id)
+    current = {}
+    for item_type, ids in wanted.items():
+        model = MODELS[item_type]
+        for item in model.query.filter(model.id.in_(ids)).all():
+            current[(item_type, item.id)] = item.serialize()
+
+    results = []
+    for change in changes:
+        result = change.serialize()
+        if change.action in ("created", "updated"):
+            result["data"] = current.get((change.item_type, change.item_id))
+        results.append(result)
+
+    return {
+        "changes": results,
+        "next_cursor": changes[-1].id if changes else since,
+        "has_more": has_more
+    }
@@ -0,0 +1,129 @@
+"""
+Request coalescing (single flight).
+
+When identical GETs arrive while one of them is already being computed, the
+later ones wait for it and answer with the same body instead of running the
+same query and serialization again. Expected errors (APIException, e.g. a
+404) are shared like any other response. A waiting request gives up after
+COALESCE_WAIT_MS (or its own deadline, if sooner) and computes the response
+itself, as it does when the request it waited on failed unexpectedly.
+
+Waiting requests don't hold an admission slot (see admission.py).
+
+Coalescing happens between the threads of one worker, so it needs the gthread
+profile (the default). The ASGI entry point serves these routes natively and
+does not coalesce them.
+"""
+import functools
+import os
+import threading
+from collections import Counter, defaultdict
+from flask import current_app, request
+from admission import resume_admission, suspend_admission
+from deadlines import DeadlineExceeded, remaining_ms
+from utils import APIException
+
+COALESCE_WAIT_MS = int(os.getenv('COALESCE_WAIT_MS', 2000))
+
+
+class Call:
+    __slots__ = ('done', 'result', 'failed')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = True
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = defaultdict(Counter)
+
+    def _count(self, name, outcome):
+        with self._lock:
+            self._counters[name]['requests'] += 1
+            self._counters[name][outcome] += 1
+
+    def in_flight(self, name, key):
+        with self._lock:
+            return (name, key) in self._calls
+
+    def do(self, name, key, fn, wait, on_lead=None, on_wait=None, on_fallback=None):
+        with self._lock:
+            call = self._calls.get((name, key))
+            leader = call is None
+            if leader:
+                call = self._calls[(name, key)] = Call()
+
+        if leader:
+            self._count(name, 'executed')
+            try:
+                if on_lead is not None:
+                    on_lead()
+                call.result = fn()
+                call.failed = False
+                return call.result
+            finally:
+                with self._lock:
+                    del self._calls[(name, key)]
+                call.done.set()
+
+        if on_wait is not None:
+            on_wait()
+        if call.done.wait(wait) and not call.failed:
+            self._count(name, 'coalesced')
+            return call.result
+        self._count(name, 'fallbacks')
+        if on_fallback is not None:
+            on_fallback()
+        return fn()
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {outcome: counter[outcome] for outcome in ('requests', 'executed', 'coalesced', 'fallbacks')}
+                for name, counter in self._counters.items()
+            }
+
+
+single_flight = SingleFlight()
+
+
+def wait_seconds():
+    wait = COALESCE_WAIT_MS
+    remaining = remaining_ms()
+    if remaining is not None:
+        wait = min(wait, remaining)
+    return max(wait, 0) / 1000
+
+
+def coalesce(view):
+    """Share the response of a GET view between identical concurrent requests."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        def render():
+            try:
+                rv = view(*args, **kwargs)
+            except DeadlineExceeded:
+                # The deadline is the leader's own, the others may still have time to do the work
+                raise
+            except APIException as e:
+                rv = current_app.handle_user_exception(e)
+            # Only the encoded body is shared, every request builds its own response object
+            response = current_app.make_response(rv)
+            return response.get_data(), response.status_code, list(response.headers)
+
+        # A request let in without a slot because an identical call was running takes one after
+        # all if it ends up doing the work (that call may have finished in the meantime)
+        body, status, headers = single_flight.do(view.__name__, request.full_path, render, wait_seconds(),
+                                                 on_lead=resume_admission, on_wait=suspend_admission,
+                                                 on_fallback=resume_admission)
+        return current_app.response_class(body, status=status, headers=headers)
+
+    # Checked by admission control before the view runs
+    wrapper.shares_in_flight = lambda: single_flight.in_flight(view.__name__, request.full_path)
+    return wrapper
@@ -0,0 +1,130 @@
+"""
+Request deadlines.
+
+Every request gets a time budget: the X-Request-Timeout header (milliseconds)
+when the client sends one, capped by the route's default (REQUEST_DEADLINE_MS,
+or the value given with @deadline on the view). The remaining budget is
+enforced on the database work of the request:
+
+- Postgres: SET LOCAL statement_timeout at the start of every transaction,
+- SQLite: a progress handler that interrupts the running statement,
+- any engine: no statement is started once the deadline has passed.
+
+Past the deadline the request is answered with a 504 instead of finishing work
+the client has stopped waiting for. The async handlers of asgi.py use the same
+budgets.
+"""
+import os
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import Pool
+from utils import APIException
+
+# 0 leaves routes without a default deadline, the header still applies
+DEFAULT_DEADLINE_MS = int(os.getenv('REQUEST_DEADLINE_MS', 10000)) or None
+# SQLite opcodes run between two checks of the progress handler
+SQLITE_PROGRESS_STEPS = 1000
+POSTGRES_QUERY_CANCELED = '57014'
+
+
+class DeadlineExceeded(APIException):
+    status_code = 504
+
+    def __init__(self, message="Request deadline exceeded"):
+        APIException.__init__(self, message)
+
+
+def deadline(ms):
+    """Set the default budget of a route, None disables the deadline."""
+    def decorator(view):
+        view.deadline_ms = ms
+        return view
+    return decorator
+
+
+def remaining_ms():
+    # None when the current request (if any) has no deadline
+    if not has_request_context():
+        return None
+    expires_at = g.get('deadline')
+    if expires_at is None:
+        return None
+    return (expires_at - time.monotonic()) * 1000
+
+
+def check_deadline():
+    remaining = remaining_ms()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
+
+
+@event.listens_for(Session, 'after_begin')
+def _apply_statement_timeout(session, transaction, connection):
+    remaining = remaining_ms()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise DeadlineExceeded()
+
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(remaining), 1)}")
+    elif connection.dialect.name == 'sqlite':
+        expires_at = g.deadline
+        connection.connection.dbapi_connection.set_progress_handler(
+            lambda: time.monotonic() > expires_at, SQLITE_PROGRESS_STEPS
+        )
+
+
+@event.listens_for(Pool, 'checkin')
+def _clear_progress_handler(dbapi_connection, connection_record):
+    # The handler belongs to the request that set it, not to the pooled connection
+    if dbapi_connection is not None and hasattr(dbapi_connection, 'set_progress_handler'):
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _check_before_statement(conn, cursor, statement, parameters, context, executemany):
+    check_deadline()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _translate_timeout(exception_context):
+    remaining = remaining_ms()
+    if remaining is None:
+        return None
+    original = exception_context.original_exception
+    canceled = getattr(original, 'pgcode', None) == POSTGRES_QUERY_CANCELED or str(original) == 'interrupted'
+    if canceled or remaining <= 0:
+        return DeadlineExceeded()
+    return None
+
+
+def budget_ms(view, header):
+    """Budget of a request to `view` given its X-Request-Timeout header, None if unlimited."""
+    budget = getattr(view, 'deadline_ms', DEFAULT_DEADLINE_MS)
+    if header is not None:
+        try:
+            client_budget = int(header)
+        except ValueError:
+            raise APIException("X-Request-Timeout must be a number of milliseconds", 400)
+        budget = client_budget if budget is None else min(budget, client_budget)
+    return budget
+
+
+def request_budget_ms():
+    return budget_ms(current_app.view_functions.get(request.endpoint), request.headers.get('X-Request-Timeout'))
+
+
+def setup_deadlines(app):
+
+    @app.before_request
+    def start_deadline():
+        budget = request_budget_ms()
+        if budget is None:
+            return
+        if budget <= 0:
+            raise DeadlineExceeded()
+        g.deadline = time.monotonic() + budget / 1000
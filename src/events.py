@@ -0,0 +1,246 @@
+"""
+Server-Sent Events for favorites and catalog changes.
+
+The change_log written by changes.py is the event bus: every worker runs one
+background thread that polls it and fans new rows out to the streams it is
+serving, so events reach clients whatever worker handled the write. The log id
+is the SSE event id, which lets a reconnecting client resume with
+`Last-Event-ID` from the database.
+
+Streams send a heartbeat comment every SSE_HEARTBEAT seconds and close after
+SSE_MAX_STREAM_SECONDS (the browser reconnects and resumes on its own). A
+client more than SSE_REPLAY_LIMIT events behind is sent one page of them per
+connection until it has caught up.
+
+The ASGI entry point serves streams from async handlers (async_stream), an
+open stream only costs a queue and a coroutine. The Flask routes
+(stream_response) hold a worker thread per stream, so gunicorn.conf.py caps
+them with hub.max_blocking_streams: a share of the threads of a gthread
+worker, none at all on sync workers.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+from flask import Response
+from models import Change
+from utils import APIException
+
+SSE_POLL_INTERVAL = float(os.getenv('SSE_POLL_INTERVAL', 1))
+SSE_HEARTBEAT = float(os.getenv('SSE_HEARTBEAT', 15))
+SSE_MAX_STREAM_SECONDS = float(os.getenv('SSE_MAX_STREAM_SECONDS', 300))
+SSE_MAX_STREAMS = int(os.getenv('SSE_MAX_STREAMS', 100))
+SSE_QUEUE_SIZE = 1000
+SSE_REPLAY_LIMIT = 1000
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+
+class Subscription:
+    # Read by a thread blocked on the queue for as long as the stream is open
+    blocking = True
+
+    def __init__(self, user_id):
+        # user_id None is the catalog channel
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def wants(self, change):
+        return change.user_id == self.user_id
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # The client is too slow, end its stream so it reconnects and replays from the log
+            self.overflowed = True
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read by a coroutine, events are handed over to its event loop."""
+    blocking = False
+
+    def __init__(self, user_id, loop):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def push(self, event):
+        # Called from the hub thread, asyncio queues may only be touched from their loop
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The loop is closed, the stream is going away anyway
+            self.overflowed = True
+
+
+class ChangeHub:
+    """Polls change_log and hands new changes to the subscriptions of this worker."""
+
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.app = None
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = None
+        # Cap on the streams holding a thread each, None for no cap beyond SSE_MAX_STREAMS
+        self.max_blocking_streams = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def subscribe(self, subscription):
+        with self._lock:
+            if subscription.blocking and self.max_blocking_streams is not None:
+                if self.max_blocking_streams == 0:
+                    raise APIException("Event streams are disabled on this worker", 503)
+                if sum(s.blocking for s in self._subscriptions) >= self.max_blocking_streams:
+                    raise APIException("Too many open event streams, try again later", 503, headers={"Retry-After": "5"})
+            if len(self._subscriptions) >= SSE_MAX_STREAMS:
+                raise APIException("Too many open event streams, try again later", 503, headers={"Retry-After": "5"})
+            if self._last_id is None:
+                # Only changes committed from now on are pushed live, older ones come from replay()
+                last = Change.query.order_by(Change.id.desc()).first()
+                self._last_id = last.id if last is not None else 0
+            self._subscriptions.add(subscription)
+            # Started lazily so it runs in the worker process, not in a preloading master
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='change-hub', daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _poll(self):
+        with self.app.app_context():
+            changes = Change.query.filter(Change.id > self._last_id).order_by(Change.id).limit(500).all()
+            events = [(change, format_event(change)) for change in changes]
+        if changes:
+            self._last_id = changes[-1].id
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for change, event in events:
+            for subscription in subscriptions:
+                if subscription.wants(change):
+                    subscription.push((change.id, event))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscriptions:
+                    self._thread = None
+                    self._last_id = None
+                    return
+            try:
+                self._poll()
+            except Exception as e:
+                self.app.logger.error("Change hub poll failed: %s", e)
+            time.sleep(self.poll_interval)
+
+
+hub = ChangeHub(SSE_POLL_INTERVAL)
+
+
+def format_event(change):
+    return f"id: {change.id}\nevent: {change.action}\ndata: {json.dumps(change.serialize())}\n\n"
+
+
+def parse_last_event_id(value):
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise APIException("Last-Event-ID must be a change cursor", 400)
+    return int(value)
+
+
+def replay(user_id, last_event_id):
+    changes = (
+        Change.query
+        .filter(Change.id > last_event_id, Change.user_id == user_id if user_id is not None else Change.user_id.is_(None))
+        .order_by(Change.id)
+        .limit(SSE_REPLAY_LIMIT)
+        .all()
+    )
+    return [(change.id, format_event(change)) for change in changes]
+
+
+def open_stream(subscription, last_event_id):
+    # Subscribe before replaying, so nothing committed in between is missed
+    hub.subscribe(subscription)
+    try:
+        return replay(subscription.user_id, last_event_id) if last_event_id is not None else []
+    except Exception:
+        hub.unsubscribe(subscription)
+        raise
+
+
+def retry_directive(backlog):
+    # A full replay page may not reach the changes the hub pushes live, so such a stream ends
+    # right after it and the browser soon reconnects with the last id sent to get the next page
+    caught_up = len(backlog) < SSE_REPLAY_LIMIT
+    return caught_up, f"retry: {2000 if caught_up else 100}\n\n"
+
+
+def stream_response(user_id, last_event_id):
+    subscription = Subscription(user_id)
+    backlog = open_stream(subscription, last_event_id)
+
+    def generate():
+        sent_id = backlog[-1][0] if backlog else (last_event_id or 0)
+        deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        caught_up, retry = retry_directive(backlog)
+        try:
+            # Tell the browser how long to wait before reconnecting when the stream ends
+            yield retry
+            for event_id, event in backlog:
+                yield event
+            while caught_up and time.monotonic() < deadline and not subscription.overflowed:
+                try:
+                    event_id, event = subscription.queue.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                if event_id > sent_id:
+                    sent_id = event_id
+                    yield event
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+
+async def async_stream(subscription, backlog, last_event_id):
+    """Same stream as stream_response() for an AsyncSubscription opened with open_stream()."""
+    sent_id = backlog[-1][0] if backlog else (last_event_id or 0)
+    deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+    caught_up, retry = retry_directive(backlog)
+    try:
+        yield retry
+        for event_id, event in backlog:
+            yield event
+        while caught_up and time.monotonic() < deadline and not subscription.overflowed:
+            try:
+                event_id, event = await asyncio.wait_for(subscription.queue.get(), SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if event_id > sent_id:
+                sent_id = event_id
+                yield event
+    finally:
+        hub.unsubscribe(subscription)
@@ -1,23 +1,28 @@
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from tracing import traced
 
 db = SQLAlchemy()
 
 favorite_people = db.Table(
     "favorite_people",
     db.Column("favorite_id", db.Integer, db.ForeignKey("favorite.id")),
-    db.Column("people_id", db.Integer, db.ForeignKey("people.id"))
+    db.Column("people_id", db.Integer, db.ForeignKey("people.id")),
+    db.Column("created_at", db.DateTime, nullable=False, default=datetime.utcnow)
 )
 
 favorite_planets = db.Table(
     "favorite_planets",
     db.Column("favorite_id", db.Integer, db.ForeignKey("favorite.id")),
-    db.Column("planet_id", db.Integer, db.ForeignKey("planet.id"))
+    db.Column("planet_id", db.Integer, db.ForeignKey("planet.id")),
+    db.Column("created_at", db.DateTime, nullable=False, default=datetime.utcnow)
 )
 
 favorite_vehicles = db.Table(
     "favorite_vehicles",
     db.Column("favorite_id", db.Integer, db.ForeignKey("favorite.id")),
-    db.Column("vehicle_id", db.Integer, db.ForeignKey("vehicle.id"))
+    db.Column("vehicle_id", db.Integer, db.ForeignKey("vehicle.id")),
+    db.Column("created_at", db.DateTime, nullable=False, default=datetime.utcnow)
 )
 
 class User(db.Model):
@@ -30,6 +35,7 @@ class User(db.Model):
     def __repr__(self):
         return '<User %r>' % self.email
 
+    @traced()
     def serialize(self):
         return {
             "id": self.id,
@@ -48,6 +54,7 @@ class Favorite(db.Model):
     def __repr__(self):
         return '<Favorite %r>' % self.id
 
+    @traced()
     def serialize(self):
         return {
             "user_id": self.user_id,
@@ -66,11 +73,14 @@ class People(db.Model):
     skin_color = db.Column(db.String(200), nullable=True)
     eye_color = db.Column(db.String(200), nullable=True)
     birth_year = db.Column(db.String(200), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     
     def __repr__(self):
         return '<People %r>' % self.name
     
+    @traced()
     def serialize(self):
         return {
             "id": self.id,
@@ -95,10 +105,13 @@ class Planet(db.Model):
     rotation_period = db.Column(db.Integer, nullable=True)
     orbital_period = db.Column(db.Integer, nullable=True)
     surface_water = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return '<Planet %r' % self.name
     
+    @traced()
     def serialize(self):
         return {
             "id": self.id,
@@ -125,11 +138,14 @@ class Vehicle(db.Model):
     passengers = db.Column(db.String(200), nullable=True)
     max_atmosphering_speed = db.Column(db.String(200), nullable=True)
     cargo_capacity = db.Column(db.String(200), nullable=True)
-    consumables = db.Column(db.String(200), nullable=True)    
+    consumables = db.Column(db.String(200), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def __repr__(self):
         return '<Vehicle %r>' % self.name
     
+    @traced()
     def serialize(self):
         return {
             "id": self.id,
@@ -144,4 +160,55 @@ class Vehicle(db.Model):
             "max_atmosphering_speed": self.max_atmosphering_speed,
             "cargo_capacity": self.cargo_capacity,
             "consumables": self.consumables,
-        }
\ No newline at end of file
+        }
+
+class FavoriteCount(db.Model):
+    # How many users have each item in their favorites, kept up to date by the favorite endpoints
+    __tablename__ = "favorite_count"
+    __table_args__ = (
+        db.Index("ix_favorite_count_ranking", "item_type", "count", "item_id"),
+    )
+    item_type = db.Column(db.String(20), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<FavoriteCount %s #%r: %r>' % (self.item_type, self.item_id, self.count)
+
+class FavoriteCooccurrence(db.Model):
+    # How many users have both items in their favorites, only the top pairs of each item are kept
+    __tablename__ = "favorite_cooccurrence"
+    __table_args__ = (
+        db.Index("ix_favorite_cooccurrence_lookup", "item_type", "item_id", "count"),
+    )
+    item_type = db.Column(db.String(20), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True)
+    related_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<FavoriteCooccurrence %s #%r-#%r: %r>' % (self.item_type, self.item_id, self.related_id, self.count)
+
+class Change(db.Model):
+    # Append-only log read by GET /changes, the id is the sync cursor
+    __tablename__ = "change_log"
+    id = db.Column(db.Integer, primary_key=True)
+    item_type = db.Column(db.String(20), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True, index=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Change %r: %s %s #%r>' % (self.id, self.action, self.item_type, self.item_id)
+
+    @traced()
+    def serialize(self):
+        return {
+            "cursor": self.id,
+            "type": self.item_type,
+            "id": self.item_id,
+            "action": self.action,
+            "user_id": self.user_id,
+            "at": self.created_at.isoformat()
+        }
@@ -0,0 +1,52 @@
+"""
+Per item favorite counters backing the /<items>/popular endpoints.
+
+The favorite endpoints bump the counter in the same transaction that changes
+the favorites, so ranking is a single index scan on favorite_count instead of
+a GROUP BY over the association tables. `flask rebuild-favorite-counts`
+recomputes every counter from the association tables to fix any drift.
+"""
+from sqlalchemy import func, insert, literal, select
+from models import db, FavoriteCount, People, Planet, Vehicle, favorite_people, favorite_planets, favorite_vehicles
+from utils import increment_counters
+
+# item_type -> (model, association table column holding the item id)
+FAVORITE_ITEMS = {
+    "people": (People, favorite_people.c.people_id),
+    "planet": (Planet, favorite_planets.c.planet_id),
+    "vehicle": (Vehicle, favorite_vehicles.c.vehicle_id),
+}
+
+DEFAULT_POPULAR_LIMIT = 10
+MAX_POPULAR_LIMIT = 100
+
+
+def bump_favorite_count(item_type, item_id, delta):
+    keys = [{"item_type": item_type, "item_id": item_id}]
+    increment_counters(db.session, FavoriteCount.__table__, keys, delta)
+
+
+def get_popular(item_type, limit):
+    model = FAVORITE_ITEMS[item_type][0]
+    rows = (
+        db.session.query(model, FavoriteCount.count)
+        .join(model, model.id == FavoriteCount.item_id)
+        .filter(FavoriteCount.item_type == item_type, FavoriteCount.count > 0)
+        .order_by(FavoriteCount.count.desc(), FavoriteCount.item_id.desc())
+        .limit(limit)
+        .all()
+    )
+    return [dict(item.serialize(), favorites_count=count) for item, count in rows]
+
+
+def rebuild_favorite_counts():
+    table = FavoriteCount.__table__
+    db.session.execute(table.delete())
+    for item_type, (model, item_column) in FAVORITE_ITEMS.items():
+        counts = (
+            select(literal(item_type), item_column, func.count())
+            .where(item_column.isnot(None))
+            .group_by(item_column)
+        )
+        db.session.execute(insert(table).from_select(["item_type", "item_id", "count"], counts))
+    db.session.commit()
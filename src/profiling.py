@@ -0,0 +1,145 @@
+"""
+Opt-in request profiling and slow SQL logging.
+
+A request is profiled when it carries a valid signed `X-Profile` header or is
+picked by the sampling rate. Profiles are written as `.prof` files (open them
+with `python -m pstats` or snakeviz). SQL statements slower than a threshold
+are logged with their parameters and the database EXPLAIN plan.
+
+All knobs can be changed at runtime through the JSON file named by
+PROFILING_CONFIG, e.g. {"sample_rate": 0.01, "slow_query_ms": 200}
+"""
+import cProfile
+import logging
+import os
+import random
+import re
+import time
+from flask import g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from utils import RuntimeSettings
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_SALT = 'request-profile'
+
+settings = RuntimeSettings(os.getenv('PROFILING_CONFIG'), {
+    'sample_rate': float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+    'profile_dir': os.getenv('PROFILE_DIR', '/tmp/profiles'),
+    'token_max_age': int(os.getenv('PROFILE_TOKEN_MAX_AGE', 3600)),
+    'slow_query_ms': float(os.getenv('SLOW_QUERY_MS', 0)),
+    'explain_slow_queries': os.getenv('SLOW_QUERY_EXPLAIN', '1') == '1',
+})
+
+
+def generate_profile_token(secret):
+    return URLSafeTimedSerializer(secret, salt=PROFILE_TOKEN_SALT).dumps('profile')
+
+
+def has_valid_profile_token(secret):
+    token = request.headers.get(PROFILE_HEADER)
+    if not token or not secret:
+        return False
+    try:
+        URLSafeTimedSerializer(secret, salt=PROFILE_TOKEN_SALT).loads(token, max_age=settings.get('token_max_age'))
+    except BadSignature:
+        return False
+    return True
+
+
+def should_profile(secret):
+    if has_valid_profile_token(secret):
+        return True
+    sample_rate = settings.get('sample_rate')
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def dump_profile(profiler):
+    profile_dir = settings.get('profile_dir')
+    os.makedirs(profile_dir, exist_ok=True)
+    endpoint = re.sub(r'[^A-Za-z0-9_.-]', '_', request.endpoint or 'unknown')
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}-{random.randrange(1 << 16):04x}.prof"
+    path = os.path.join(profile_dir, filename)
+    profiler.dump_stats(path)
+    return path
+
+
+def explain(conn, statement, parameters):
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    # On Postgres a failed statement aborts the whole transaction, so the EXPLAIN runs in a
+    # savepoint: if it fails (e.g. cancelled by the statement timeout) the request can go on
+    savepoint = conn.dialect.name == 'postgresql'
+    # Use the raw DBAPI cursor so the EXPLAIN itself does not go through the engine events
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute("SAVEPOINT explain_slow_query")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = [" ".join(str(col) for col in row) for row in cursor.fetchall()]
+        except Exception:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            raise
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+    finally:
+        cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_start_time = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _log_slow_query(conn, cursor, statement, parameters, context, executemany):
+    threshold = settings.get('slow_query_ms')
+    start_time = getattr(context, '_query_start_time', None)
+    if threshold <= 0 or start_time is None:
+        return
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    if elapsed_ms < threshold:
+        return
+
+    plan = None
+    if settings.get('explain_slow_queries') and not executemany and statement.lstrip().upper().startswith('SELECT'):
+        try:
+            plan = explain(conn, statement, parameters)
+        except Exception as e:
+            plan = [f"EXPLAIN failed: {e}"]
+
+    logger.warning("Slow query (%.1f ms): %s | params=%r | plan=%s", elapsed_ms, statement, parameters, plan)
+
+
+def setup_profiling(app):
+    secret = os.environ.get('PROFILING_SECRET')
+
+    @app.before_request
+    def start_profiler():
+        if should_profile(secret):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        try:
+            path = dump_profile(profiler)
+            app.logger.info("Profiled %s %s -> %s", request.method, request.path, path)
+        except OSError as e:
+            app.logger.error("Could not write profile for %s: %s", request.path, e)
+
+    # `flask profile-token` prints a header value valid for token_max_age seconds
+    @app.cli.command('profile-token')
+    def print_profile_token():
+        if not secret:
+            raise SystemExit("PROFILING_SECRET is not set")
+        print(f"{PROFILE_HEADER}: {generate_profile_token(secret)}")
@@ -0,0 +1,100 @@
+"""
+"Users who favorited X also favorited" lookups for /<items>/<id>/related.
+
+`flask rebuild-related` builds the item x item co-occurrence counts of every
+item type as a sparse matrix product (favorites^T . favorites) and stores the
+top RELATED_TOP_K pairs of each item in favorite_cooccurrence, so a lookup is
+a single index range scan. Schedule it (e.g. nightly) to keep the index tidy.
+
+Between rebuilds the favorite endpoints update the counts of the pairs they
+touch, so new favorites show up right away.
+"""
+import os
+from sqlalchemy import insert, select
+from models import db, FavoriteCooccurrence
+from popularity import FAVORITE_ITEMS
+from utils import increment_counters
+
+RELATED_TOP_K = int(os.getenv('RELATED_TOP_K', 50))
+DEFAULT_RELATED_LIMIT = 10
+MAX_RELATED_LIMIT = 50
+
+
+def record_cooccurrence(item_type, item_id, other_ids, delta):
+    # Called when item_id is added to (delta=1) or removed from (delta=-1) favorites that hold other_ids
+    keys = []
+    for other_id in other_ids:
+        if other_id == item_id:
+            continue
+        keys.append({"item_type": item_type, "item_id": item_id, "related_id": other_id})
+        keys.append({"item_type": item_type, "item_id": other_id, "related_id": item_id})
+    increment_counters(db.session, FavoriteCooccurrence.__table__, keys, delta)
+
+
+def get_related(item_type, item_id, limit):
+    model = FAVORITE_ITEMS[item_type][0]
+    rows = (
+        db.session.query(model, FavoriteCooccurrence.count)
+        .join(model, model.id == FavoriteCooccurrence.related_id)
+        .filter(
+            FavoriteCooccurrence.item_type == item_type,
+            FavoriteCooccurrence.item_id == item_id,
+            FavoriteCooccurrence.count > 0
+        )
+        .order_by(FavoriteCooccurrence.count.desc(), FavoriteCooccurrence.related_id)
+        .limit(limit)
+        .all()
+    )
+    return [dict(item.serialize(), favorited_together=count) for item, count in rows]
+
+
+def top_cooccurrences(favorite_ids, item_ids, top_k):
+    """
+    Returns (item_ids, related_ids, counts) arrays holding the top_k most
+    co-favorited items of every item, from parallel arrays of
+    (favorite_id, item_id) memberships.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    favorites, favorite_index = np.unique(favorite_ids, return_inverse=True)
+    items, item_index = np.unique(item_ids, return_inverse=True)
+    memberships = sparse.csr_matrix(
+        (np.ones(len(item_index), dtype=np.int32), (favorite_index, item_index)),
+        shape=(len(favorites), len(items))
+    )
+    # Duplicated rows in the association table must not count twice
+    memberships.data[:] = 1
+
+    cooccurrence = (memberships.T @ memberships).tocsr()
+    cooccurrence.setdiag(0)
+    cooccurrence.eliminate_zeros()
+
+    # Rank the entries of every row by count (ties by related id) and keep the first top_k
+    rows = np.repeat(np.arange(cooccurrence.shape[0]), np.diff(cooccurrence.indptr))
+    order = np.lexsort((cooccurrence.indices, -cooccurrence.data, rows))
+    rank = np.arange(len(order)) - cooccurrence.indptr[rows[order]]
+    keep = order[rank < top_k]
+    return items[rows[keep]], items[cooccurrence.indices[keep]], cooccurrence.data[keep]
+
+
+def rebuild_related(top_k=RELATED_TOP_K):
+    table = FavoriteCooccurrence.__table__
+    db.session.execute(table.delete())
+    for item_type, (model, item_column) in FAVORITE_ITEMS.items():
+        favorite_column = item_column.table.c.favorite_id
+        memberships = db.session.execute(
+            select(favorite_column, item_column)
+            .where(favorite_column.isnot(None), item_column.isnot(None))
+        ).all()
+        if not memberships:
+            continue
+        favorite_ids, item_ids = zip(*memberships)
+        item_ids, related_ids, counts = top_cooccurrences(favorite_ids, item_ids, top_k)
+        rows = [
+            {"item_type": item_type, "item_id": int(item_id), "related_id": int(related_id), "count": int(count)}
+            for item_id, related_id, count in zip(item_ids, related_ids, counts)
+        ]
+        if rows:
+            db.session.execute(insert(table), rows)
+    db.session.commit()
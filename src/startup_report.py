@@ -0,0 +1,71 @@
+"""
+Cold start report.
+
+Imports the app in a fresh interpreter with `python -X importtime` and prints
+how long each module took to import plus the time spent building the app
+itself. Exits with status 1 when the total is above STARTUP_BUDGET_MS, so it
+can be used as a check before deploying.
+
+    $ pipenv run startup-report
+"""
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_N = int(os.getenv('STARTUP_REPORT_TOP', 15))
+
+# Runs in the child interpreter, prints the wall time of `import app` in microseconds
+PROBE = "import time; t = time.perf_counter(); import app; print(int((time.perf_counter() - t) * 1e6))"
+
+
+def parse_importtime(stderr):
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return modules
+
+
+def main():
+    budget_ms = float(os.getenv('STARTUP_BUDGET_MS', 1500))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE],
+        cwd=SRC_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        return result.returncode
+
+    total_ms = int(result.stdout.strip().splitlines()[-1]) / 1000
+    modules = parse_importtime(result.stderr)
+    # -X importtime lists a module after everything it imported, children are one level deeper
+    app_index = next(i for i, m in enumerate(modules) if m[0] == 'app' and m[1] == 0)
+    app_module = modules[app_index]
+    first_child = app_index
+    while first_child > 0 and modules[first_child - 1][1] > 0:
+        first_child -= 1
+    direct_imports = [m for m in modules[first_child:app_index] if m[1] == 1]
+
+    print(f"{'module':<40} {'self ms':>10} {'cumulative ms':>14}")
+    print("Slowest modules (self time):")
+    for name, depth, self_us, cumulative_us in sorted(modules, key=lambda m: m[2], reverse=True)[:TOP_N]:
+        print(f"  {name:<38} {self_us / 1000:>10.1f} {cumulative_us / 1000:>14.1f}")
+    print("Imported by the app (in import order):")
+    for name, depth, self_us, cumulative_us in direct_imports:
+        print(f"  {name:<38} {self_us / 1000:>10.1f} {cumulative_us / 1000:>14.1f}")
+
+    print(f"App setup (app.py module body): {app_module[2] / 1000:.1f} ms")
+    print(f"Total `import app`: {total_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+
+    if total_ms > budget_ms:
+        print("Cold start is over budget", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Catalog statistics served from an in-memory, column oriented copy of the
+numeric and categorical catalog columns.
+
+Each dataset is loaded into numpy arrays (categories are stored as integer
+codes), so group-bys and histograms are a handful of vectorized operations
+instead of a table scan. Rows created through this worker's endpoints are
+appended to a copy of the loaded arrays; copies older than STATS_MAX_AGE
+seconds are reloaded, which picks up writes handled by other workers.
+"""
+import os
+import threading
+import time
+from models import db, People, Planet
+from utils import APIException
+
+STATS_MAX_AGE = float(os.getenv('STATS_MAX_AGE', 60))
+MAX_HISTOGRAM_BINS = 100
+
+DATASETS = {
+    "people": {
+        "model": People,
+        "numeric": ["height", "mass"],
+        "categorical": ["gender", "hair_color", "skin_color", "eye_color"]
+    },
+    "planets": {
+        "model": Planet,
+        "numeric": ["population", "diameter", "rotation_period", "orbital_period", "surface_water"],
+        "categorical": ["climate", "terrain"]
+    }
+}
+
+
+class ColumnSnapshot:
+    """Immutable column arrays of one dataset, as loaded at `loaded_at`."""
+
+    def __init__(self, ids, numeric, categories, codes, size, loaded_at=None):
+        self.ids = ids
+        self.numeric = numeric
+        self.categories = categories
+        self.codes = codes
+        self.size = size
+        self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+
+    @classmethod
+    def load(cls, model, numeric_columns, categorical_columns):
+        import numpy as np
+
+        columns = [model.id] + [getattr(model, c) for c in numeric_columns + categorical_columns]
+        rows = db.session.query(*columns).all()
+        values = list(zip(*rows)) if rows else [()] * len(columns)
+        ids, values = np.array(values[0], dtype=np.int64), values[1:]
+
+        # None becomes NaN in the float arrays and "" in the category labels
+        numeric = {}
+        for name, column_values in zip(numeric_columns, values):
+            numeric[name] = np.array(column_values, dtype=np.float64)
+
+        categories, codes = {}, {}
+        for name, column_values in zip(categorical_columns, values[len(numeric_columns):]):
+            labels = np.array(["" if v is None else str(v) for v in column_values], dtype=str)
+            categories[name], codes[name] = np.unique(labels, return_inverse=True)
+        return cls(ids, numeric, categories, codes, len(rows))
+
+    def append(self, item):
+        """Copy of the snapshot with `item` as one more row, same as a reload would give."""
+        import numpy as np
+
+        if np.any(self.ids == item.id):
+            return self
+
+        numeric = {}
+        for name, values in self.numeric.items():
+            numeric[name] = np.append(values, np.array([getattr(item, name)], dtype=np.float64))
+
+        # Labels stay sorted like np.unique returns them, a new label shifts the codes after it
+        categories, codes = {}, {}
+        for name, labels in self.categories.items():
+            value = getattr(item, name)
+            label = "" if value is None else str(value)
+            position = int(np.searchsorted(labels, label))
+            column_codes = self.codes[name]
+            if position == len(labels) or labels[position] != label:
+                labels = np.concatenate((labels[:position], np.array([label]), labels[position:]))
+                column_codes = np.where(column_codes >= position, column_codes + 1, column_codes)
+            categories[name] = labels
+            codes[name] = np.append(column_codes, position)
+        return ColumnSnapshot(np.append(self.ids, item.id), numeric, categories, codes, self.size + 1, self.loaded_at)
+
+
+class CatalogStats:
+
+    def __init__(self, datasets, max_age):
+        self.datasets = datasets
+        self.max_age = max_age
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def add(self, dataset, item):
+        """Add an item this worker just created to the loaded copy instead of reloading it all."""
+        with self._lock:
+            current = self._snapshots.get(dataset)
+            if current is not None:
+                self._snapshots[dataset] = current.append(item)
+
+    def config(self, dataset):
+        if dataset not in self.datasets:
+            raise APIException(f"There are no stats for {dataset}", 404)
+        return self.datasets[dataset]
+
+    def snapshot(self, dataset):
+        config = self.config(dataset)
+        current = self._snapshots.get(dataset)
+        if current is not None and time.monotonic() - current.loaded_at < self.max_age:
+            return current
+        with self._lock:
+            current = self._snapshots.get(dataset)
+            if current is None or time.monotonic() - current.loaded_at >= self.max_age:
+                current = ColumnSnapshot.load(config["model"], config["numeric"], config["categorical"])
+                self._snapshots[dataset] = current
+        return current
+
+    def check_numeric(self, dataset, column):
+        numeric_columns = self.config(dataset)["numeric"]
+        if column not in numeric_columns:
+            raise APIException(f"'{column}' is not a numeric column of {dataset}, use one of: {', '.join(numeric_columns)}", 400)
+
+    def numeric_column(self, dataset, column):
+        self.check_numeric(dataset, column)
+        return self.snapshot(dataset).numeric[column]
+
+    def describe(self):
+        return {
+            name: {"numeric": config["numeric"], "categorical": config["categorical"]}
+            for name, config in self.datasets.items()
+        }
+
+    def group_by(self, dataset, by, column):
+        import numpy as np
+
+        categorical_columns = self.config(dataset)["categorical"]
+        if by not in categorical_columns:
+            raise APIException(f"Can't group {dataset} by '{by}', use one of: {', '.join(categorical_columns)}", 400)
+        self.check_numeric(dataset, column)
+        # One snapshot for values and codes, a reload or append in between would change their lengths
+        snapshot = self.snapshot(dataset)
+        values, labels, codes = snapshot.numeric[column], snapshot.categories[by], snapshot.codes[by]
+
+        present = ~np.isnan(values)
+        group_codes, group_values = codes[present], values[present]
+        rows = np.bincount(codes, minlength=len(labels))
+        counts = np.bincount(group_codes, minlength=len(labels))
+        sums = np.bincount(group_codes, weights=group_values, minlength=len(labels))
+        minimums = np.full(len(labels), np.inf)
+        maximums = np.full(len(labels), -np.inf)
+        np.minimum.at(minimums, group_codes, group_values)
+        np.maximum.at(maximums, group_codes, group_values)
+
+        groups = []
+        for i, label in enumerate(labels):
+            has_values = counts[i] > 0
+            groups.append({
+                by: label or None,
+                "rows": int(rows[i]),
+                "count": int(counts[i]),
+                "sum": float(sums[i]) if has_values else None,
+                "mean": float(sums[i] / counts[i]) if has_values else None,
+                "min": float(minimums[i]) if has_values else None,
+                "max": float(maximums[i]) if has_values else None
+            })
+        return {"dataset": dataset, "by": by, "column": column, "groups": groups}
+
+    def histogram(self, dataset, column, bins):
+        import numpy as np
+
+        values = self.numeric_column(dataset, column)
+        values = values[~np.isnan(values)]
+        bins = min(max(bins, 1), MAX_HISTOGRAM_BINS)
+        counts, edges = np.histogram(values, bins=bins)
+        return {
+            "dataset": dataset,
+            "column": column,
+            "count": int(len(values)),
+            "edges": [float(e) for e in edges],
+            "counts": [int(c) for c in counts]
+        }
+
+
+catalog_stats = CatalogStats(DATASETS, STATS_MAX_AGE)
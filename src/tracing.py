@@ -0,0 +1,295 @@
+"""
+Lightweight request tracing.
+
+Spans are opened around WSGI dispatch, the route handler, every SQL statement,
+the model serialize() methods and JSON encoding. Finished spans are queued and
+written in batches by a background thread as JSON lines to TRACE_FILE, so a
+trace can be analyzed offline without running a collector.
+
+Incoming W3C `traceparent` headers are honoured and the current trace context
+is returned in the response `traceparent` header.
+
+Tracing is disabled unless TRACE_FILE is set.
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def _new_id(bits):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attributes', 'status', 'start_time', '_start', 'duration_ms')
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.status = 'ok'
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        if exporter is not None:
+            exporter.export(self)
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attributes": self.attributes
+        }
+
+
+class BatchFileExporter:
+    """
+    Writes finished spans to a JSON lines file from a background thread.
+
+    Spans are dropped (and counted) instead of blocking the request when the
+    queue is full.
+    """
+
+    def __init__(self, path, max_queue_size=10000, batch_size=512, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self.start()
+        atexit.register(self.shutdown)
+
+    def start(self):
+        # Also called in forked workers, threads of the parent process don't survive a fork
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='span-exporter', daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        with open(self.path, 'a') as f:
+            f.write("".join(json.dumps(span.to_dict(), default=str) + "\n" for span in batch))
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            batch = self._drain()
+            while batch:
+                self._write(batch)
+                batch = self._drain()
+
+    def shutdown(self):
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+
+exporter = None
+sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', 1))
+
+
+def start_span(name, **attributes):
+    # Child spans are only created inside a sampled trace, so untraced requests pay almost nothing
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+class span:
+    """Context manager that records a child span of the current span."""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self._span = None
+        self._token = None
+
+    def __enter__(self):
+        self._span = start_span(self.name, **self.attributes)
+        if self._span is not None:
+            self._token = current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is None:
+            return False
+        current_span.reset(self._token)
+        if exc is not None:
+            self._span.status = 'error'
+            self._span.attributes['error'] = repr(exc)
+        self._span.finish()
+        return False
+
+
+def traced(name=None):
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current_span.get() is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def parse_traceparent(header):
+    match = TRACEPARENT_RE.match((header or '').strip().lower())
+    if match is None:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    if trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+    return trace_id, parent_id, int(flags, 16) & 1 == 1
+
+
+class TracingMiddleware:
+    """WSGI middleware that opens the root span of every sampled request."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        incoming = parse_traceparent(environ.get('HTTP_TRACEPARENT'))
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id, sampled = _new_id(128), None, random.random() < sample_rate
+
+        if not sampled:
+            return self.wsgi_app(environ, start_response)
+
+        root = Span('wsgi.dispatch', trace_id, parent_id, {
+            "http.method": environ.get('REQUEST_METHOD'),
+            "http.target": environ.get('PATH_INFO')
+        })
+        token = current_span.set(root)
+
+        def traced_start_response(status, headers, exc_info=None):
+            root.attributes['http.status_code'] = int(status.split(' ', 1)[0])
+            headers = [h for h in headers if h[0].lower() != 'traceparent']
+            headers.append(('traceparent', root.traceparent))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.wsgi_app(environ, traced_start_response)
+        except Exception as e:
+            root.status = 'error'
+            root.attributes['error'] = repr(e)
+            raise
+        finally:
+            current_span.reset(token)
+            root.finish()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_sql_span(conn, cursor, statement, parameters, context, executemany):
+    sql_span = start_span('sql.execute', statement=statement, executemany=executemany)
+    if sql_span is not None:
+        context._trace_span = sql_span
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_sql_span(conn, cursor, statement, parameters, context, executemany):
+    sql_span = getattr(context, '_trace_span', None)
+    if sql_span is not None:
+        sql_span.attributes['rowcount'] = cursor.rowcount
+        sql_span.finish()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _fail_sql_span(exception_context):
+    context = exception_context.execution_context
+    sql_span = getattr(context, '_trace_span', None)
+    if sql_span is not None:
+        sql_span.status = 'error'
+        sql_span.attributes['error'] = repr(exception_context.original_exception)
+        sql_span.finish()
+
+
+def setup_tracing(app):
+    global exporter
+    trace_file = os.getenv('TRACE_FILE')
+    if not trace_file:
+        return
+
+    exporter = BatchFileExporter(trace_file)
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)
+
+    json_provider = app.json
+    original_dumps = json_provider.dumps
+
+    def traced_dumps(obj, **kwargs):
+        with span('json.encode'):
+            return original_dumps(obj, **kwargs)
+    json_provider.dumps = traced_dumps
+
+    @app.before_request
+    def start_handler_span():
+        handler_span = start_span(f"handler.{request.endpoint}")
+        if handler_span is not None:
+            if request.url_rule is not None:
+                handler_span.attributes['http.route'] = request.url_rule.rule
+            request.environ['tracing.handler_span'] = (handler_span, current_span.set(handler_span))
+
+    @app.teardown_request
+    def finish_handler_span(exc):
+        handler = request.environ.pop('tracing.handler_span', None)
+        if handler is None:
+            return
+        handler_span, token = handler
+        current_span.reset(token)
+        if exc is not None:
+            handler_span.status = 'error'
+            handler_span.attributes['error'] = repr(exc)
+        handler_span.finish()
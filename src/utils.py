@@ -1,20 +1,58 @@
+import json
+import os
+import time
 from flask import jsonify, url_for
+from sqlalchemy import insert, update
 
 class APIException(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers or {}
 
     def to_dict(self):
         rv = dict(self.payload or ())
         rv['message'] = self.message
         return rv
 
+def increment_counters(session, table, keys, delta, column='count'):
+    """
+    Adds `delta` to `column` on every row of `table` identified by the dicts in
+    `keys`. When delta is positive, missing rows are created with delta.
+    """
+    if not keys:
+        return
+    key_columns = list(keys[0])
+    counter = table.c[column]
+    dialect_name = session.get_bind().dialect.name
+
+    if delta > 0 and dialect_name in ('postgresql', 'sqlite'):
+        if dialect_name == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        stmt = upsert(table).values([dict(key, **{column: delta}) for key in keys])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c[c] for c in key_columns],
+            set_={column: counter + stmt.excluded[column]}
+        )
+        session.execute(stmt)
+        return
+
+    for key in keys:
+        result = session.execute(
+            update(table)
+            .where(*[table.c[c] == value for c, value in key.items()])
+            .values({column: counter + delta})
+        )
+        if result.rowcount == 0 and delta > 0:
+            session.execute(insert(table).values(dict(key, **{column: delta})))
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
@@ -39,3 +77,50 @@ def generate_sitemap(app):
         <p>Start working on your proyect by following the <a href="https://start.4geeksacademy.com/starters/flask" target="_blank">Quick Start</a></p>
         <p>Remember to specify a real endpoint path like: </p>
         <ul style="text-align: left;">"""+links_html+"</ul></div>"
+
+
+class RuntimeSettings:
+    """
+    Settings that can be changed while the server is running.
+
+    Defaults come from the environment; if `path` points to a JSON file its
+    keys override them. The file is re-read whenever it changes on disk, so
+    editing it takes effect on the next request without a redeploy. The file
+    is checked at most once every `check_interval` seconds.
+    """
+
+    def __init__(self, path, defaults, check_interval=1.0):
+        self.path = path
+        self.defaults = dict(defaults)
+        self.check_interval = check_interval
+        self._values = dict(defaults)
+        self._mtime = None
+        self._checked_at = None
+
+    def _reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if self._mtime is not None:
+                self._values, self._mtime = dict(self.defaults), None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                overrides = json.load(f)
+        except (OSError, ValueError):
+            return
+        values = dict(self.defaults)
+        values.update({k: v for k, v in overrides.items() if k in self.defaults})
+        self._values, self._mtime = values, mtime
+
+    def get(self, key):
+        self._reload()
+        return self._values[key]